@@ -4,25 +4,48 @@ print("Starting upscayl service...")
 
 print("Testing imports...")
 try:
-    print("Importing flask...")
-    from flask import Flask, request, send_file, jsonify
-    print("Flask imported successfully")
+    print("Importing quart...")
+    from quart import Quart, Request, Response, request, send_file, jsonify
+    from quart.wrappers.response import FileBody
+    from werkzeug.exceptions import RequestEntityTooLarge
+    from werkzeug.datastructures import FileStorage
+    from werkzeug.utils import secure_filename
+    print("Quart imported successfully")
 except ImportError as e:
-    print(f"Flask import error: {e}")
+    print(f"Quart import error: {e}")
     exit(1)
 
 try:
     print("Importing standard libraries...")
+    import asyncio
+    import atexit
+    import contextlib
+    import logging
+    import logging.handlers
     import os
+    import queue
+    import shutil
     import subprocess
     import tempfile
     import uuid
     import io
+    import zipfile
     print("Standard libraries imported successfully")
 except ImportError as e:
     print(f"Standard library import error: {e}")
     exit(1)
 
+try:
+    print("Importing blake3...")
+    from blake3 import blake3 as content_hash
+    print("blake3 imported successfully")
+except ImportError as e:
+    print(f"blake3 import error: {e}")
+    print("Falling back to hashlib.blake2b...")
+    from functools import partial
+    from hashlib import blake2b
+    content_hash = partial(blake2b, digest_size=32)
+
 try:
     print("Importing PIL...")
     from PIL import Image
@@ -33,7 +56,7 @@ except ImportError as e:
 
 try:
     print("Importing rembg...")
-    from rembg import remove
+    from rembg import remove, new_session
     print("rembg imported successfully")
 except ImportError as e:
     print(f"rembg import error: {e}")
@@ -46,14 +69,112 @@ except Exception as e:
 
 print("All imports successful")
 
-app = Flask(__name__)
+app = Quart(__name__)
+
+# Per-request logging goes through a queue and is written out by a listener
+# thread, so handlers never block on a backed-up stderr. Set LOG_LEVEL=DEBUG
+# for per-request traces.
+log = logging.getLogger('upscayl')
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+log.propagate = False
+log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(log_queue))
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Quart caps request bodies at 16 MB by default, too small for print-ready art
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("MAX_UPLOAD_BYTES", 256 * 1024 * 1024))
 
 UPSCAYL_PATH = "/opt/upscayl/upscayl-bin"
+UPSCAYL_MODEL = "realesrgan-x4plus"  # Default model
 TEMP_DIR = "/tmp/upscayl"
 
+# Multipart uploads up to this size stay in memory instead of being spooled to disk
+SPOOL_MAX_MEMORY = int(os.environ.get("SPOOL_MAX_MEMORY", 1024 * 1024))
+
+# zlib level for PNGs this service encodes itself: 1 is several times faster
+# than PIL's default of 6 for slightly larger files
+OUTPUT_PNG_COMPRESS = int(os.environ.get("OUTPUT_PNG_COMPRESS", 1))
+
+# Upscaled results keyed by input content hash; set UPSCAYL_CACHE_DIR="" to disable
+UPSCAYL_CACHE_DIR = os.environ.get("UPSCAYL_CACHE_DIR", "/var/cache/upscayl") or None
+UPSCAYL_CACHE_MAX_BYTES = int(os.environ.get("UPSCAYL_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# Bound concurrent work to what the hardware can sustain: one upscayl
+# process per GPU (more just thrash VRAM), and one rembg inference per session.
+# GPU_IDS lists the Vulkan device ids to use; by default 0..GPU_COUNT-1
+GPU_COUNT = int(os.environ.get("GPU_COUNT", 1))
+GPU_IDS = os.environ.get("GPU_IDS", ",".join(str(i) for i in range(GPU_COUNT))).split(",")
+# Idle GPU ids; each upscayl run takes one and is pinned to that device
+free_gpus = asyncio.Queue()
+for gpu_id in GPU_IDS:
+    free_gpus.put_nowait(gpu_id)
+# Most single-image requests waiting on a GPU slot that may share one upscayl run
+UPSCAYL_MAX_BATCH = int(os.environ.get("UPSCAYL_MAX_BATCH", 8))
+
+# rembg model and ONNX Runtime providers; unavailable providers fall back to CPU
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+REMBG_PROVIDERS = os.environ.get(
+    "REMBG_PROVIDERS", "CUDAExecutionProvider,CPUExecutionProvider").split(",")
+# Independent ONNX sessions, each held by one request at a time, so requests overlap
+REMBG_SESSIONS = int(os.environ.get("REMBG_SESSIONS", 1))
+# ONNX Runtime already spreads each inference over every core, and upscaled
+# inputs can need several GB, so run no more inferences than there are sessions
+REMBG_CONCURRENCY = int(os.environ.get("REMBG_CONCURRENCY", REMBG_SESSIONS))
+rembg_slots = asyncio.Semaphore(REMBG_CONCURRENCY)
+
 # Ensure temp directory exists
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+def is_tmpfs(path):
+    """Check whether path lives on a tmpfs (RAM-backed) mount"""
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return False
+
+    path = os.path.realpath(path)
+    mount_point, fs_type = "", ""
+    for fields in mounts:
+        candidate = fields[1]
+        if path == candidate or path.startswith(candidate.rstrip("/") + "/"):
+            if len(candidate) > len(mount_point):
+                mount_point, fs_type = candidate, fields[2]
+    return fs_type == "tmpfs"
+
+if UPSCAYL_CACHE_DIR is not None:
+    try:
+        os.makedirs(UPSCAYL_CACHE_DIR, exist_ok=True)
+        print(f"Caching upscaled images in {UPSCAYL_CACHE_DIR}")
+    except OSError as e:
+        print(f"Error creating cache directory: {e}")
+        print("Continuing without upscale cache...")
+        UPSCAYL_CACHE_DIR = None
+
+# Every request writes and reads back multi-MB PNGs here, so keep it in RAM
+if is_tmpfs(TEMP_DIR):
+    print(f"Temp directory {TEMP_DIR} is on tmpfs")
+else:
+    print(f"WARNING: Temp directory {TEMP_DIR} is not on tmpfs; mount one for faster image I/O")
+
+def spool_to_temp_dir(total_content_length, content_type, filename, content_length=None):
+    """Spool multipart file parts to TEMP_DIR once they outgrow SPOOL_MAX_MEMORY"""
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, dir=TEMP_DIR)
+
+class UploadRequest(Request):
+    """Request whose file uploads are streamed straight to TEMP_DIR"""
+
+    def make_form_data_parser(self):
+        parser = super().make_form_data_parser()
+        parser.stream_factory = spool_to_temp_dir
+        return parser
+
+app.request_class = UploadRequest
+
 # Check if upscayl binary exists
 print(f"Checking for upscayl binary at {UPSCAYL_PATH}")
 print(f"Directory contents of /opt/upscayl:")
@@ -81,8 +202,78 @@ if not os.access(UPSCAYL_PATH, os.X_OK):
 else:
     print("Upscayl binary is executable")
 
-def run_upscayl(input_path, output_path, scale=4):
-    """Run Upscayl NCNN binary to upscale an image"""
+# Load the rembg model once so every request reuses a resident ONNX session
+rembg_sessions = []
+if remove is not None:
+    try:
+        print(f"Loading {REMBG_SESSIONS} rembg {REMBG_MODEL} session(s) with providers {REMBG_PROVIDERS}...")
+        rembg_sessions = [new_session(REMBG_MODEL, providers=REMBG_PROVIDERS)
+                          for _ in range(REMBG_SESSIONS)]
+        print("rembg model loaded successfully")
+    except Exception as e:
+        print(f"rembg model load error: {e}")
+        print("Continuing without rembg...")
+        remove = None
+# Idle rembg sessions; each inference takes one so no session runs two at once
+free_rembg_sessions = asyncio.Queue()
+for session in rembg_sessions:
+    free_rembg_sessions.put_nowait(session)
+
+@contextlib.asynccontextmanager
+async def rembg_session():
+    """Wait for an idle rembg session and hold it; yields None without rembg"""
+    if remove is None:
+        yield None
+        return
+    session = await free_rembg_sessions.get()
+    try:
+        yield session
+    finally:
+        free_rembg_sessions.put_nowait(session)
+
+class StreamingFileBody(FileBody):
+    """File response body that reads 1 MiB per chunk instead of Quart's 8 KiB"""
+
+    buffer_size = 1024 * 1024
+
+class ImageResponse(Response):
+    file_body_class = StreamingFileBody
+
+app.response_class = ImageResponse
+
+class TempFileBody(StreamingFileBody):
+    """File response body that deletes the file once it has been sent"""
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        try:
+            await super().__aexit__(exc_type, exc_value, tb)
+        finally:
+            discard(self.file_path)
+
+async def send_temp_file(path, download_name, mimetype='image/png'):
+    """Send a temporary file as an attachment, removing it after streaming"""
+    response = await send_file(path, mimetype=mimetype, as_attachment=True,
+                               attachment_filename=download_name)
+    response.response = TempFileBody(path)
+    return response
+
+@contextlib.asynccontextmanager
+async def gpu_slot():
+    """Wait for an idle GPU and hold it, yielding its device id"""
+    gpu_id = await free_gpus.get()
+    try:
+        yield gpu_id
+    finally:
+        free_gpus.put_nowait(gpu_id)
+
+async def run_upscayl(input_path, output_path, scale=4, timeout=600, gpu_id=None):
+    """Run Upscayl NCNN binary to upscale an image
+
+    input_path and output_path may also be directories, in which case every
+    image in input_path is upscaled in a single run (one model load).
+    Callers must hold the gpu_slot() for gpu_id while this runs.
+    """
+    proc = None
     try:
         # Upscayl NCNN CLI command
         cmd = [
@@ -90,178 +281,619 @@ def run_upscayl(input_path, output_path, scale=4):
             "-i", input_path,
             "-o", output_path,
             "-s", str(scale),
-            "-m", "realesrgan-x4plus",  # Default model
+            "-m", UPSCAYL_MODEL,
             "-f", "png"
         ]
-
-        print(f"Running command: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=600, cwd="/opt/upscayl")
-
-        print(f"Upscayl stdout: {result.stdout}")
-        if result.stderr:
-            print(f"Upscayl stderr: {result.stderr}")
-
-        if result.returncode != 0:
-            print(f"Upscayl error: return code {result.returncode}")
+        if gpu_id is not None:
+            cmd += ["-g", gpu_id]
+
+        log.debug("Running command: %s", ' '.join(cmd))
+        # Progress output is discarded; stderr is only decoded if the run fails
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            close_fds=True, cwd="/opt/upscayl")
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+
+        if proc.returncode != 0:
+            log.error("Upscayl exited with return code %s: %s",
+                      proc.returncode, stderr.decode(errors='replace'))
             return False
 
         # Check if output file was created
-        if not os.path.exists(output_path):
-            print(f"Output file not found: {output_path}")
+        if not has_output(output_path):
+            log.error("Output file not found: %s", output_path)
             return False
 
         return True
-    except subprocess.TimeoutExpired:
-        print("Upscayl process timed out")
+    except asyncio.TimeoutError:
+        log.error("Upscayl process timed out")
         return False
     except Exception as e:
-        print(f"Error running Upscayl: {e}")
+        log.error("Error running Upscayl: %s", e)
         return False
+    finally:
+        # Never leave upscayl running on a GPU the caller is about to hand
+        # back, whether the run timed out or the request was cancelled
+        if proc is not None and proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
 
-def remove_background(input_path, output_path):
-    """Remove background from image using rembg"""
+def discard(path):
+    """Remove a file if it exists"""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+class UpscaylBatcher:
+    """Coalesce concurrent single-image upscales into directory-mode runs
+
+    upscayl-bin has no daemon mode, so every run pays the Vulkan and model
+    load again. Jobs that queue up while the GPU slots are busy are instead
+    staged together and upscaled by a single run once a slot frees up.
+    """
+
+    def __init__(self, max_batch):
+        self.max_batch = max_batch
+        self.pending = {}
+        self.drains = set()
+
+    async def upscale(self, input_path, output_path, scale=4):
+        future = asyncio.get_running_loop().create_future()
+        jobs = self.pending.setdefault(scale, [])
+        jobs.append((input_path, output_path, future))
+        if len(jobs) == 1:
+            self._schedule_drain(scale)
+        return await future
+
+    def _schedule_drain(self, scale):
+        # Keep a reference so the drain task isn't garbage collected mid-run
+        task = asyncio.create_task(self._drain(scale))
+        self.drains.add(task)
+        task.add_done_callback(self.drains.discard)
+
+    async def _drain(self, scale):
+        # Jobs keep joining the pending list until a GPU is free
+        async with gpu_slot() as gpu_id:
+            jobs = self.pending.pop(scale)
+            if len(jobs) > self.max_batch:
+                self.pending[scale] = jobs[self.max_batch:]
+                jobs = jobs[:self.max_batch]
+                self._schedule_drain(scale)
+
+            jobs = [job for job in jobs if not job[2].done()]
+            if len(jobs) == 1:
+                input_path, output_path, future = jobs[0]
+                success = await run_upscayl(input_path, output_path, scale, gpu_id=gpu_id)
+                if future.cancelled():
+                    # The request went away and already cleaned up; upscayl
+                    # recreated its output, so remove it again
+                    discard(output_path)
+                elif not future.done():
+                    future.set_result(success)
+            elif jobs:
+                await self._run_batch(jobs, scale, gpu_id)
+
+    async def _run_batch(self, jobs, scale, gpu_id):
+        batch_dir = os.path.join(TEMP_DIR, f"coalesced_{uuid.uuid4()}")
+        in_dir = os.path.join(batch_dir, "in")
+        out_dir = os.path.join(batch_dir, "out")
+        try:
+            os.makedirs(in_dir)
+            os.makedirs(out_dir)
+
+            # Hard-link the inputs into one directory so nothing is copied
+            staged = []
+            for index, (input_path, output_path, future) in enumerate(jobs):
+                name = f"{index:04d}"
+                try:
+                    os.link(input_path, os.path.join(in_dir, name + os.path.splitext(input_path)[1]))
+                except OSError as e:
+                    log.warning("Could not stage %s for batch: %s", input_path, e)
+                    if not future.done():
+                        future.set_result(False)
+                    continue
+                staged.append((name, output_path, future))
+
+            log.debug("Upscaling %d coalesced images in one run", len(staged))
+            await run_upscayl(in_dir, out_dir, scale, timeout=600 * len(staged), gpu_id=gpu_id)
+
+            for name, output_path, future in staged:
+                result_path = os.path.join(out_dir, f"{name}.png")
+                if future.cancelled():
+                    # Don't recreate an output the cancelled request already removed
+                    discard(result_path)
+                    continue
+                success = os.path.exists(result_path)
+                if success:
+                    os.replace(result_path, output_path)
+                else:
+                    log.error("Output file not found: %s", result_path)
+                if not future.done():
+                    future.set_result(success)
+        except Exception as e:
+            log.error("Error running coalesced Upscayl batch: %s", e)
+            for _, _, future in jobs:
+                if not future.done():
+                    future.set_result(False)
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+upscayl_batcher = UpscaylBatcher(UPSCAYL_MAX_BATCH)
+
+# Transparent and opaque image modes that PNG and BMP staging store without a
+# conversion pass (a full-image copy per upload)
+PNG_ALPHA_MODES = ('LA', 'P', 'RGBA')
+BMP_OPAQUE_MODES = ('L', 'P', 'RGB')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def is_png(file):
+    """Sniff the PNG signature rather than trusting the declared content type"""
+    header = file.stream.read(len(PNG_SIGNATURE))
+    file.stream.seek(0)
+    return header == PNG_SIGNATURE
+
+def has_alpha(image):
+    """Check whether a PIL image carries transparency"""
+    return 'A' in image.getbands() or 'transparency' in image.info
+
+def save_upload(file, dest_dir, prefix):
+    """Stage an upload in dest_dir under a unique name suffixed for its format
+
+    PNGs are copied as-is. Anything else is decoded once and written as an
+    uncompressed BMP, which upscayl and rembg read just as well but which
+    skips the zlib pass a PNG re-encode would cost. Transparent non-PNG
+    uploads are written as a fast, lightly compressed PNG instead.
+    Blocking; run it in a worker thread. Returns the staged path.
+    """
+    if is_png(file):
+        fd, path = tempfile.mkstemp('.png', prefix, dest_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(file.stream, f, 1024 * 1024)
+        except BaseException:
+            discard(path)
+            raise
+        return path
+
+    # Only convert modes the staging format can't store as they are;
+    # upscayl and rembg expand greyscale and palette images themselves
+    with Image.open(file.stream) as image:
+        # PIL reads BMP alpha back as opaque, so transparent images stay PNG
+        if has_alpha(image):
+            if image.mode not in PNG_ALPHA_MODES:
+                image = image.convert('RGBA')
+            suffix, options = ".png", {'format': 'PNG', 'compress_level': OUTPUT_PNG_COMPRESS,
+                                       'optimize': False}
+        else:
+            if image.mode not in BMP_OPAQUE_MODES:
+                image = image.convert('RGB')
+            suffix, options = ".bmp", {'format': 'BMP'}
+
+        fd, path = tempfile.mkstemp(suffix, prefix, dest_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, **options)
+        except BaseException:
+            discard(path)
+            raise
+        return path
+
+def has_output(path):
+    """Check that a result was written; single-file outputs are pre-created empty"""
+    return os.path.isdir(path) or (os.path.isfile(path) and os.path.getsize(path) > 0)
+
+def hash_upload(file):
+    """Hash the raw upload bytes, leaving the stream rewound for saving"""
+    digest = content_hash()
+    for chunk in iter(lambda: file.stream.read(1024 * 1024), b""):
+        digest.update(chunk)
+    file.stream.seek(0)
+    return digest.hexdigest()
+
+def write_chunks(f, digest, chunks):
+    """Append request body chunks to f and feed them to the content hash"""
+    for chunk in chunks:
+        digest.update(chunk)
+        f.write(chunk)
+
+def cache_path_for(digest, scale):
+    """Cache path for the upscaled result of an input with the given content hash"""
+    return os.path.join(UPSCAYL_CACHE_DIR, f"{digest}_{scale}_{UPSCAYL_MODEL}.png")
+
+async def upscale_cache_path(file, scale):
+    """Return the cache path for this upload's upscaled result, or None if caching is off"""
+    if UPSCAYL_CACHE_DIR is None:
+        return None
+    digest = await asyncio.to_thread(hash_upload, file)
+    return cache_path_for(digest, scale)
+
+async def send_cached(cache_path, download_name):
+    """Send a cached result and mark it recently used; return None on a miss"""
+    try:
+        os.utime(cache_path)
+        return await send_file(cache_path, mimetype='image/png', as_attachment=True,
+                               attachment_filename=download_name)
+    except FileNotFoundError:
+        return None
+
+def store_in_cache(output_path, cache_path):
+    """Copy a fresh result into the cache, then evict least recently used entries"""
+    try:
+        partial_path = f"{cache_path}.{uuid.uuid4()}.partial"
+        shutil.copyfile(output_path, partial_path)
+        os.replace(partial_path, cache_path)
+
+        entries = []
+        for entry in os.scandir(UPSCAYL_CACHE_DIR):
+            if entry.is_file() and entry.name.endswith('.png'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= UPSCAYL_CACHE_MAX_BYTES:
+                break
+            os.remove(path)
+            total -= size
+    except OSError as e:
+        log.warning("Error updating upscale cache: %s", e)
+
+def zip_directory(src_dir, zip_path):
+    """Zip every file in src_dir; PNGs are already compressed, so store them as-is"""
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for name in sorted(os.listdir(src_dir)):
+            zf.write(os.path.join(src_dir, name), arcname=name)
+
+def remove_background(input_path, output_path, session):
+    """Remove background from image using rembg and a session held by the caller
+
+    A missing input raises FileNotFoundError, so callers reading a cache
+    entry that was just evicted can fall back to producing it.
+    """
     if remove is None:
-        print("rembg not available, cannot remove background")
+        log.error("rembg not available, cannot remove background")
         return False
 
     try:
-        print(f"Removing background from: {input_path}")
+        log.debug("Removing background from: %s", input_path)
 
-        # Open and remove background
+        # rembg handles mode conversion itself; encode the result here so the
+        # PNG compression level is ours rather than PIL's slow default
         with Image.open(input_path) as img:
-            # Convert to RGBA if not already
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
+            output_img = remove(img, session=session)
 
-            # Remove background
-            output_img = remove(img)
+        output_img.save(output_path, 'PNG', compress_level=OUTPUT_PNG_COMPRESS, optimize=False)
 
-            # Save the result
-            output_img.save(output_path, 'PNG')
-
-        print(f"Background removed successfully: {output_path}")
+        log.debug("Background removed successfully: %s", output_path)
         return True
+    except FileNotFoundError:
+        raise
     except Exception as e:
-        print(f"Error removing background: {e}")
+        log.error("Error removing background: %s", e)
         return False
 
+# /process actions and the filename prefix of the image each one returns
+PROCESS_ACTIONS = {
+    'upscale': 'upscaled',
+    'remove_bg': 'nobg',
+    'upscale_and_nobg': 'upscaled_nobg',
+}
+
 @app.route('/process', methods=['POST'])
-def process_image():
+async def process_image():
+    input_path = upscaled_path = output_path = None
     try:
         # Get the uploaded file
-        if 'image' not in request.files:
+        files = await request.files
+        form = await request.form
+        if 'image' not in files:
             return jsonify({'error': 'No image provided'}), 400
 
-        file = request.files['image']
+        file = files['image']
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
 
         # Get action parameter
-        action = request.form.get('action', 'upscale')
+        action = form.get('action', 'upscale')
+        if action not in PROCESS_ACTIONS:
+            return jsonify({'error': 'Invalid action specified'}), 400
 
-        # Generate unique filenames
-        unique_id = str(uuid.uuid4())
-        input_path = os.path.join(TEMP_DIR, f"input_{unique_id}.png")
-        output_path = os.path.join(TEMP_DIR, f"output_{unique_id}.png")
+        cache_path = None
+        if action in ('upscale', 'upscale_and_nobg'):
+            # Get scale parameter (default to 4)
+            scale = int(form.get('scale', 4))
+            cache_path = await upscale_cache_path(file, scale)
+
+        # Serve repeat uploads straight from the cache
+        if action == 'upscale' and cache_path is not None:
+            response = await send_cached(cache_path, f"upscaled_{file.filename}")
+            if response is not None:
+                return response
 
-        # Save uploaded file as PNG
-        image = Image.open(file.stream)
-        image.save(input_path, 'PNG')
+        # Stage the upload (PNG as-is, other formats as BMP) and reserve the output
+        input_path = await asyncio.to_thread(save_upload, file, TEMP_DIR, 'in_')
+        out_fd, output_path = tempfile.mkstemp('.png', 'out_', TEMP_DIR)
+        os.close(out_fd)
 
         success = False
 
         if action == 'upscale':
-            # Get scale parameter (default to 4)
-            scale = int(request.form.get('scale', 4))
-            success = run_upscayl(input_path, output_path, scale)
+            success = await upscayl_batcher.upscale(input_path, output_path, scale)
         elif action == 'remove_bg':
-            success = remove_background(input_path, output_path)
-        else:
-            return jsonify({'error': 'Invalid action specified'}), 400
-
-        # Clean up input file
-        if os.path.exists(input_path):
-            os.remove(input_path)
-
-        if not success or not os.path.exists(output_path):
+            async with rembg_slots, rembg_session() as session:
+                success = await asyncio.to_thread(remove_background, input_path, output_path, session)
+        elif action == 'upscale_and_nobg':
+            # rembg reads a cached upscale of the same upload in place; once
+            # opened it stays readable even if eviction removes it meanwhile
+            cached = False
+            if cache_path is not None:
+                try:
+                    os.utime(cache_path)
+                    async with rembg_slots, rembg_session() as session:
+                        success = await asyncio.to_thread(remove_background, cache_path,
+                                                          output_path, session)
+                    cached = True
+                except FileNotFoundError:
+                    pass
+
+            if not cached:
+                # Keep the upscaled intermediate on the ramdisk and feed it straight
+                # to rembg, rather than round-tripping it through the client
+                up_fd, upscaled_path = tempfile.mkstemp('.png', 'up_', TEMP_DIR)
+                os.close(up_fd)
+                success = await upscayl_batcher.upscale(input_path, upscaled_path, scale)
+                if success and cache_path is not None:
+                    await asyncio.to_thread(store_in_cache, upscaled_path, cache_path)
+                if success:
+                    async with rembg_slots, rembg_session() as session:
+                        success = await asyncio.to_thread(remove_background, upscaled_path,
+                                                          output_path, session)
+
+        if not success or not has_output(output_path):
             return jsonify({'error': f'Failed to {action.replace("_", " ")} image'}), 500
 
+        if action == 'upscale' and cache_path is not None:
+            await asyncio.to_thread(store_in_cache, output_path, cache_path)
+
         # Return the processed image
-        action_name = "upscaled" if action == "upscale" else "nobg"
-        return send_file(output_path, mimetype='image/png', as_attachment=True,
-                        download_name=f"{action_name}_{file.filename}")
+        response = await send_temp_file(output_path, f"{PROCESS_ACTIONS[action]}_{file.filename}")
+        output_path = None
+        return response
+
+    except RequestEntityTooLarge:
+        return jsonify({'error': 'Image too large'}), 413
 
     except Exception as e:
-        print(f"Error processing request: {e}")
+        log.error("Error processing request: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
     finally:
-        # Clean up output file after sending
-        if 'output_path' in locals() and os.path.exists(output_path):
-            try:
-                os.remove(output_path)
-            except:
-                pass
+        # Clean up the input, and the output unless it was handed off to the response
+        for path in (input_path, upscaled_path, output_path):
+            if path is not None:
+                discard(path)
 
 @app.route('/upscale', methods=['POST'])
-def upscale_image():
+async def upscale_image():
     """Legacy endpoint for backward compatibility"""
+    input_path = output_path = None
     try:
         # Get the uploaded file
-        if 'file' not in request.files:
+        files = await request.files
+        form = await request.form
+        if 'file' not in files:
             return jsonify({'error': 'No file provided'}), 400
 
-        file = request.files['file']
+        file = files['file']
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
 
         # Get scale parameter (default to 4)
-        scale = int(request.form.get('scale', 4))
+        scale = int(form.get('scale', 4))
 
-        # Generate unique filenames
-        unique_id = str(uuid.uuid4())
-        input_path = os.path.join(TEMP_DIR, f"input_{unique_id}.png")
-        output_path = os.path.join(TEMP_DIR, f"output_{unique_id}.png")
+        # Serve repeat uploads straight from the cache
+        cache_path = await upscale_cache_path(file, scale)
+        if cache_path is not None:
+            response = await send_cached(cache_path, f"upscaled_{file.filename}")
+            if response is not None:
+                return response
 
-        # Save uploaded file as PNG
-        image = Image.open(file.stream)
-        image.save(input_path, 'PNG')
+        # Stage the upload (PNG as-is, other formats as BMP) and reserve the output
+        input_path = await asyncio.to_thread(save_upload, file, TEMP_DIR, 'in_')
+        out_fd, output_path = tempfile.mkstemp('.png', 'out_', TEMP_DIR)
+        os.close(out_fd)
 
         # Run Upscayl
-        success = run_upscayl(input_path, output_path, scale)
+        success = await upscayl_batcher.upscale(input_path, output_path, scale)
+
+        if not success or not has_output(output_path):
+            return jsonify({'error': 'Failed to upscale image'}), 500
 
-        # Clean up input file
-        if os.path.exists(input_path):
-            os.remove(input_path)
+        if cache_path is not None:
+            await asyncio.to_thread(store_in_cache, output_path, cache_path)
 
-        if not success or not os.path.exists(output_path):
+        # Return the upscaled image
+        response = await send_temp_file(output_path, f"upscaled_{file.filename}")
+        output_path = None
+        return response
+
+    except RequestEntityTooLarge:
+        return jsonify({'error': 'Image too large'}), 413
+
+    except Exception as e:
+        log.error("Error processing request: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+    finally:
+        # Clean up the input, and the output unless it was handed off to the response
+        for path in (input_path, output_path):
+            if path is not None:
+                discard(path)
+
+@app.route('/upscale_raw', methods=['POST'])
+async def upscale_raw():
+    """Upscale an image sent as the raw request body, skipping multipart parsing
+
+    Scale and download filename come from the query string, e.g.
+    POST /upscale_raw?scale=4&filename=design.png. The image type is sniffed
+    from the body, so the Content-Type header doesn't matter.
+    """
+    raw_path = input_path = output_path = None
+    try:
+        # Get scale parameter (default to 4)
+        scale = int(request.args.get('scale', 4))
+        filename = request.args.get('filename') or "image.png"
+
+        # Stream the body straight to disk, hashing it on the way for the cache.
+        # Chunks are gathered up to 1 MiB and hashed and written in a worker
+        # thread, so large bodies don't stall the event loop
+        raw_fd, raw_path = tempfile.mkstemp('.raw', 'raw_', TEMP_DIR)
+        digest = content_hash()
+        header = b''
+        size = 0
+        with open(raw_fd, 'wb') as f:
+            chunks = []
+            buffered = 0
+            async for chunk in request.body:
+                if len(header) < len(PNG_SIGNATURE):
+                    header += chunk[:len(PNG_SIGNATURE) - len(header)]
+                chunks.append(chunk)
+                buffered += len(chunk)
+                if buffered >= 1024 * 1024:
+                    await asyncio.to_thread(write_chunks, f, digest, chunks)
+                    size += buffered
+                    chunks = []
+                    buffered = 0
+            if chunks:
+                await asyncio.to_thread(write_chunks, f, digest, chunks)
+                size += buffered
+
+        if size == 0:
+            return jsonify({'error': 'No image provided'}), 400
+
+        # Serve repeat uploads straight from the cache
+        cache_path = None
+        if UPSCAYL_CACHE_DIR is not None:
+            cache_path = cache_path_for(digest.hexdigest(), scale)
+            response = await send_cached(cache_path, f"upscaled_{filename}")
+            if response is not None:
+                return response
+
+        # PNGs go to upscayl as received; anything else is staged like a multipart upload
+        if header == PNG_SIGNATURE:
+            input_path = os.path.splitext(raw_path)[0] + ".png"
+            os.rename(raw_path, input_path)
+            raw_path = None
+        else:
+            with open(raw_path, 'rb') as raw:
+                upload = FileStorage(raw, content_type=request.mimetype)
+                input_path = await asyncio.to_thread(save_upload, upload, TEMP_DIR, 'in_')
+        out_fd, output_path = tempfile.mkstemp('.png', 'out_', TEMP_DIR)
+        os.close(out_fd)
+
+        # Run Upscayl
+        success = await upscayl_batcher.upscale(input_path, output_path, scale)
+
+        if not success or not has_output(output_path):
             return jsonify({'error': 'Failed to upscale image'}), 500
 
+        if cache_path is not None:
+            await asyncio.to_thread(store_in_cache, output_path, cache_path)
+
         # Return the upscaled image
-        return send_file(output_path, mimetype='image/png', as_attachment=True,
-                        download_name=f"upscaled_{file.filename}")
+        response = await send_temp_file(output_path, f"upscaled_{filename}")
+        output_path = None
+        return response
+
+    except RequestEntityTooLarge:
+        return jsonify({'error': 'Image too large'}), 413
 
     except Exception as e:
-        print(f"Error processing request: {e}")
+        log.error("Error processing request: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
     finally:
-        # Clean up output file after sending
-        if 'output_path' in locals() and os.path.exists(output_path):
-            try:
-                os.remove(output_path)
-            except:
-                pass
+        # Clean up the upload, and the output unless it was handed off to the response
+        for path in (raw_path, input_path, output_path):
+            if path is not None:
+                discard(path)
+
+@app.route('/process_batch', methods=['POST'])
+async def process_batch():
+    """Upscale several images with a single upscayl run and return them as a zip"""
+    batch_dir = None
+    zip_path = None
+    try:
+        files = await request.files
+        form = await request.form
+        uploads = [f for f in files.getlist('images') if f.filename]
+        if not uploads:
+            return jsonify({'error': 'No images provided'}), 400
+
+        # Get scale parameter (default to 4)
+        scale = int(form.get('scale', 4))
+
+        # Stage every upload into the batch input directory
+        unique_id = str(uuid.uuid4())
+        batch_dir = os.path.join(TEMP_DIR, f"batch_{unique_id}")
+        in_dir = os.path.join(batch_dir, "in")
+        out_dir = os.path.join(batch_dir, "out")
+        os.makedirs(in_dir)
+        os.makedirs(out_dir)
+
+        for index, file in enumerate(uploads):
+            stem = os.path.splitext(secure_filename(file.filename))[0] or "image"
+            await asyncio.to_thread(save_upload, file, in_dir, f"{index:04d}_{stem}_")
+
+        # Run Upscayl once over the whole directory
+        async with gpu_slot() as gpu_id:
+            success = await run_upscayl(in_dir, out_dir, scale, timeout=600 * len(uploads),
+                                        gpu_id=gpu_id)
+
+        if not success or not os.listdir(out_dir):
+            return jsonify({'error': 'Failed to upscale images'}), 500
+
+        zip_path = os.path.join(TEMP_DIR, f"batch_{unique_id}.zip")
+        await asyncio.to_thread(zip_directory, out_dir, zip_path)
+
+        # Return the archive; the response removes it once sent
+        response = await send_temp_file(zip_path, "upscaled.zip", mimetype='application/zip')
+        zip_path = None
+        return response
+
+    except RequestEntityTooLarge:
+        return jsonify({'error': 'Images too large'}), 413
+
+    except Exception as e:
+        log.error("Error processing batch request: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+    finally:
+        # Clean up staged inputs and outputs
+        if batch_dir is not None:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        if zip_path is not None:
+            discard(zip_path)
 
 @app.route('/health', methods=['GET'])
-def health_check():
+async def health_check():
     return jsonify({'status': 'healthy', 'service': 'upscayl'})
 
 if __name__ == '__main__':
     print("Starting Upscayl service...")
     try:
-        app.run(host='0.0.0.0', port=5001, debug=True)
+        # Serve with the same Hypercorn settings as production, without the
+        # debug reloader (which serializes requests and imports everything twice)
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+        config = Config.from_toml(os.path.join(os.path.dirname(os.path.abspath(__file__)), "hypercorn.toml"))
+        asyncio.run(serve(app, config))
     except Exception as e:
-        print(f"Error starting Flask app: {e}")
+        print(f"Error starting Quart app: {e}")
         import traceback
         traceback.print_exc()